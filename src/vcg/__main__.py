@@ -0,0 +1,4 @@
+from .app import entry
+
+if __name__ == "__main__":
+    entry()
@@ -1,55 +1,252 @@
-import os
+import gzip
+import hashlib
+import io
+import json
+import logging
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import starmap
 
 from cachelib.simple import SimpleCache
 from flask import Flask, abort, flash, request, render_template, send_file, session
 from flask_htmx import HTMX, make_response
 from flask_session.cachelib import CacheLibSessionInterface
 
-from .bible import BibleBooks, VerseRef, parse_ref
+from .bible import BibleBooks, VerseRef, parse_spans
 from .model import Verse, Card
-from .render import DOC_OPTION_MAP, CARD_OPTION_MAP, render_pdf, render_latex
+from .render import DOC_OPTION_MAP, CARD_OPTION_MAP, _validated_card_options, global_options, latex_source, pdf_bytes
+
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = b"a super secret key no one will ever guess"
-app.session_interface = CacheLibSessionInterface(client=SimpleCache(default_timeout=0))
-htmx = HTMX(app)
 
 
-bb = BibleBooks.fromfile()
-bb_pretty_map = list(bb.pretty_names())
+class LRUCache(SimpleCache):
+    """A `SimpleCache` that, once full, evicts its least-recently-used entries.
 
+    (When over its threshold, `SimpleCache` first drops every expired entry; with `default_timeout=0`
+    cachelib counts _every_ entry as expired, so a full cache would be emptied outright.)
+    """
+    def get(self, key: str):
+        with self._lock:
+            if key in self._cache:
+                self._cache[key] = self._cache.pop(key)  # most recently used goes last
+            return super().get(key)
 
-def get_cache_file() -> tuple[str | None, str | None]:
-    cache_file, mime_type = session.get("preview_cache_file"), session.get("preview_mime_type")
-    if cache_file:
-        if not os.path.exists(cache_file):
-            print(f"Ooops, cache file '{cache_file}' no longer exists?? Busting...")
-            cache_file = None
-            mime_type = None
-    return cache_file, mime_type
+    def set(self, key: str, value, timeout=None):
+        with self._lock:
+            self._cache.pop(key, None)
+            return super().set(key, value, timeout)
 
+    def _prune(self):
+        while self._over_threshold():
+            del self._cache[next(iter(self._cache))]
 
-def set_cache_file(filename: str, mime_type: str):
-    if cache_file := session.get("preview_cache_file"):
-        print(f"Deleting old cache file '{cache_file}'...")
-        os.unlink(cache_file)
-    session["preview_cache_file"] = filename
-    session["preview_mime_type"] = mime_type
 
+SESSION_CACHE_SIZE = 500
+app.session_interface = CacheLibSessionInterface(client=LRUCache(threshold=SESSION_CACHE_SIZE, default_timeout=0))
+htmx = HTMX(app)
 
-def bust_cache_file():
-    if cache_file := session.get("preview_cache_file"):
-        if os.path.exists(cache_file):
-            os.unlink(cache_file)
-        del session["preview_cache_file"]
-        del session["preview_mime_type"]
+# Card bodies (with their full verse texts) live here as one {uuid: Card} dict per session, keyed by
+# session id; evicted least-recently-used, like the sessions themselves, so a session's cards are
+# dropped together (and only once that session has gone idle). The session itself only carries the
+# ordered card uuids.
+CARD_STORE = LRUCache(threshold=SESSION_CACHE_SIZE, default_timeout=0)
+
+
+bb = BibleBooks.fromfile()
+bb_pretty_map = bb.pretty_names()
+
+# Constant template data, visible to every template without per-render context plumbing
+app.jinja_env.globals.update(
+    bookmap=bb_pretty_map,
+    card_option_map=CARD_OPTION_MAP,
+    doc_option_map=DOC_OPTION_MAP)
+
+# (key, validator, default factory) per option, for the option-setting handlers
+_CARD_OPTS = tuple((okey, odef.validate, odef.kind) for okey, odef in CARD_OPTION_MAP.items())
+_DOC_OPTS = tuple((okey, odef.validate, odef.kind) for okey, odef in DOC_OPTION_MAP.items())
+
+
+def lookup_verses(ref: str) -> list[Verse]:
+    verses = []
+    append, extend = verses.append, verses.extend
+    for start, end in parse_spans(ref, bb):
+        if start == end:
+            append(Verse(start.verse, bb[start]))
+        else:
+            extend(starmap(Verse, bb.numbered_range(start, end)))
+    return verses
+
+
+@dataclass
+class Preview:
+    """A rendered preview held in memory (`body` is gzip-compressed if `gzipped`)."""
+    body: bytes
+    mime_type: str
+    download_name: str
+    gzipped: bool = False
+
+
+class PreviewCache:
+    """Bounded LRU of rendered previews, shared across sessions and keyed by `render_key`."""
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._previews: OrderedDict[str, Preview] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._previews
+
+    def get(self, key: str | None) -> Preview | None:
+        with self._lock:
+            preview = self._previews.get(key)
+            if preview is not None:
+                self._previews.move_to_end(key)
+            return preview
+
+    def put(self, key: str, preview: Preview):
+        with self._lock:
+            self._previews[key] = preview
+            self._previews.move_to_end(key)
+            while len(self._previews) > self._maxsize:
+                self._previews.popitem(last=False)
+
+
+PREVIEW_CACHE_SIZE = 16
+preview_cache = PreviewCache(PREVIEW_CACHE_SIZE)
+# Renders in progress; each removes itself when done, whatever the outcome
+_render_jobs: dict[str, Future] = {}
+# Error messages of recently failed renders, held (boundedly) until reported once
+RENDER_FAILURES_SIZE = 16
+_render_failures: OrderedDict[str, str] = OrderedDict()
+_render_jobs_lock = threading.Lock()
+_render_pool = ThreadPoolExecutor(max_workers=2)
+
+
+def render_key(fmt: str, cards: list[Card], options: dict[str, object] | None) -> str:
+    # options are hashed as validated/defaulted (i.e., as rendered), so e.g. {} and the explicit defaults match
+    state = [(c.title, [(v.num, v.text) for v in c.verses], _validated_card_options(frozenset(c.options.items())))
+        for c in cards]
+    blob = json.dumps([fmt, state, global_options(options)], sort_keys=True)
+    return hashlib.blake2b(blob.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def render_preview(key: str, fmt: str, cards: list[Card], options: dict[str, object] | None):
+    log.debug("GENERATING %s preview", fmt)
+    try:
+        match fmt:
+            case "PDF":
+                preview = Preview(pdf_bytes(cards, options), "application/pdf", "preview.pdf")  # already compressed
+            case "LaTeX":
+                source = latex_source(cards, options).encode("utf-8")
+                preview = Preview(gzip.compress(source), "text/x-tex", "preview.tex", gzipped=True)
+        preview_cache.put(key, preview)
+    except Exception as err:
+        log.warning("Failed to generate %s preview '%s': %s", fmt, key, err)
+        with _render_jobs_lock:
+            _render_failures[key] = str(err)
+            while len(_render_failures) > RENDER_FAILURES_SIZE:
+                _render_failures.popitem(last=False)
+    finally:
+        with _render_jobs_lock:
+            del _render_jobs[key]
+
+
+def start_render(fmt: str, cards: list[Card], options: dict[str, object] | None) -> str:
+    """Queue a background render of this state (unless cached or already queued) and return its key."""
+    key = render_key(fmt, cards, options)
+    with _render_jobs_lock:
+        if key not in _render_jobs and key not in _render_failures and key not in preview_cache:
+            # no copies needed: the cards are this request's own (unpickled from CARD_STORE)
+            _render_jobs[key] = _render_pool.submit(render_preview, key, fmt, cards, options)
+    return key
+
+
+def cancel_render(key: str):
+    """Drop a queued render that no one is waiting on (no-op once it has started)."""
+    with _render_jobs_lock:
+        job = _render_jobs.get(key)
+        if job is not None and job.cancel():
+            del _render_jobs[key]
+
+
+def render_pending(key: str | None) -> bool:
+    with _render_jobs_lock:
+        job = _render_jobs.get(key)
+    return job is not None and not job.done()
+
+
+def send_preview(key: str, preview: Preview):
+    # the key is a hash of everything rendered, so it doubles as the ETag
+    body, etag = preview.body, key
+    gzipped = preview.gzipped and "gzip" in request.accept_encodings
+    if gzipped:
+        etag += "-gz"
+    elif preview.gzipped:
+        body = gzip.decompress(body)
+    response = send_file(io.BytesIO(body), mimetype=preview.mime_type, 
+        download_name=preview.download_name, conditional=True, etag=etag)
+    if preview.gzipped:
+        response.vary.add("Accept-Encoding")
+        if gzipped:
+            response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+def bust_cache_file(cards: list[Card] | None = None):
+    """Start over on the session's preview; pass `cards` if already loaded, to save reloading them."""
+    old_key = session.pop("preview_key", None)
+    if cards is None and session.get("auto_update", True):
+        cards = session_cards()
+    if session.get("auto_update", True) and cards:
+        session["preview_key"] = start_render(session.get("preview_fmt", "PDF"), cards, session.get("options"))
+    if old_key is not None and old_key != session.get("preview_key"):
+        cancel_render(old_key)  # superseded; don't let it hold up the current one
+
+
+def stored_cards() -> dict[str, Card]:
+    return CARD_STORE.get(session.sid) or {}
+
+
+def session_cards(stored: dict[str, Card] | None = None) -> list[Card]:
+    uuids = session.get("card_uuids")
+    if not uuids:
+        return []
+    if stored is None:
+        stored = stored_cards()
+    cards = [stored[uuid] for uuid in uuids if uuid in stored]
+    if len(cards) != len(uuids):
+        # evicted from the store; forget them rather than keep pointing at nothing
+        log.warning("Session %s lost %d stored card(s)", session.sid, len(uuids) - len(cards))
+        session["card_uuids"] = [c.uuid for c in cards]
+    return cards
+
+
+def save_session_card(card: Card, stored: dict[str, Card] | None = None) -> dict[str, Card]:
+    """Store `card` (into `stored`, if the session's cards are already loaded) and return the stored cards."""
+    if stored is None:
+        stored = stored_cards()
+    stored[card.uuid] = card
+    CARD_STORE.set(session.sid, stored)
+    return stored
+
+
+def add_session_card(card: Card) -> dict[str, Card]:
+    stored = save_session_card(card)
+    session.setdefault("card_uuids", []).append(card.uuid)
+    session.modified = True
+    return stored
 
 
 @app.route("/", methods=["GET", "POST"])
 def index():
-    cards = session.get("cards", [])
-    
+    cards = None
     match request.form.get("action"):
         case "Add":
             session["book"] = book = request.form["book"]
@@ -57,90 +254,92 @@ def index():
             view_title = f"{bb.pretty_name(book)} {chapvers}"
             parse_title = f"{book} {chapvers}"
             try:
-                verses = [Verse(v.verse, bb[v]) for v in parse_ref(parse_title, bb)]
+                verses = lookup_verses(parse_title)
             except Exception as err:
-                flash(f"Error parsing reference '{title}': {err}", "error")
+                flash(f"Error parsing reference '{parse_title}': {err}", "error")
             else:
-                cards.append(Card(view_title, verses))
-                session["cards"] = cards
+                cards = session_cards(add_session_card(Card(view_title, verses)))
                 session["chapvers"] = ""
-                bust_cache_file()
+                bust_cache_file(cards)
         case "Reset":
-            del session["cards"]
+            CARD_STORE.delete(session.sid)
+            session.pop("card_uuids", None)
             del session["book"]
             del session["chapvers"]
-            bust_cache_file()
+            cards = []
+            bust_cache_file(cards)
     
+    if cards is None:
+        cards = session_cards()
     return make_response(
-        render_template("index.html", 
-            bookmap=bb_pretty_map,
-            card_option_map=CARD_OPTION_MAP,
-            doc_option_map=DOC_OPTION_MAP),
+        render_template("index.html", cards=cards, 
+            ready=not render_pending(session.get("preview_key"))),
         push_url=False,
         trigger={"preview-update": True})
 
 
 @app.post("/ajax/card/new")
 def add_card():
-    cards = session.get("cards", [])
     session["book"] = book = request.form["book"]
     session["chapvers"] = chapvers = request.form["chapvers"]
     view_title = f"{bb.pretty_name(book)} {chapvers}"
     parse_title = f"{book} {chapvers}"
     try:
-        verses = [Verse(v.verse, bb[v]) for v in parse_ref(parse_title, bb)]
+        verses = lookup_verses(parse_title)
     except Exception as err:
-        flash(f"Error parsing reference '{title}': {err}", "error")
+        flash(f"Error parsing reference '{parse_title}': {err}", "error")
         return make_response("Error", 
             push_url=False, trigger={"flash-alert": True})
     else:
         new_card = Card(view_title, verses)
-        cards.append(new_card)
-        session["cards"] = cards
+        stored = add_session_card(new_card)
         session["chapvers"] = ""
-        bust_cache_file()
+        bust_cache_file(session_cards(stored))
         return make_response(
-            render_template("partials/full_card.html", 
-                card=new_card, 
-                card_option_map=CARD_OPTION_MAP),
+            render_template("partials/full_card.html", card=new_card),
             push_url=False,
             trigger={"preview-update": True})
 
 
-def get_session_card(uuid: str) -> Card:
-    cards = session.get("cards", [])
-    for c in cards:
-        if c.uuid == uuid:
-            return c
-    abort(404)
+def get_session_card(uuid: str, stored: dict[str, Card] | None = None) -> Card:
+    c = (stored if stored is not None else stored_cards()).get(uuid)
+    if c is None:
+        abort(404)
+    return c
 
 
 @app.delete("/ajax/card/<uuid>")
 def delete_card(uuid: str):
-    c = get_session_card(uuid)
-    session["cards"].remove(c)
+    stored = stored_cards()
+    if stored.pop(uuid, None) is None:
+        abort(404)
+    CARD_STORE.set(session.sid, stored)
+    session["card_uuids"].remove(uuid)
     session.modified = True
-    bust_cache_file()
-    cards = session.get("cards", [])
+    bust_cache_file(session_cards(stored))
     return make_response("OK", push_url=False, trigger={"preview-update": True})
 
 
 @app.put("/ajax/card/<uuid>/options")
 def set_card_options(uuid: str):
-    c = get_session_card(uuid)
-    for okey, odef in CARD_OPTION_MAP.items():
-        c.options[okey] = odef.validate(request.form.get(okey, odef.kind()))
-    session.modified = True
-    bust_cache_file()
+    stored = stored_cards()
+    c = get_session_card(uuid, stored)
+    form = request.form
+    for okey, validate, default in _CARD_OPTS:
+        value = form.get(okey)
+        c.options[okey] = validate(value if value is not None else default())
+    save_session_card(c, stored)
+    bust_cache_file(session_cards(stored))
     return make_response("OK", push_url=False, trigger={"preview-update": True})
 
 
 @app.put("/ajax/options")
 def set_doc_options():
-    print(request.form)
     doc_options = session.get("options", {})
-    for okey, odef in DOC_OPTION_MAP.items():
-        doc_options[okey] = odef.validate(request.form.get(okey, odef.kind()))
+    form = request.form
+    for okey, validate, default in _DOC_OPTS:
+        value = form.get(okey)
+        doc_options[okey] = validate(value if value is not None else default())
     session["options"] = doc_options
     bust_cache_file()
     return make_response("OK", push_url=False, trigger={"preview-update": True})
@@ -156,36 +355,48 @@ def preview_config():
 
 @app.get("/ajax/preview/<fmt>")
 def preview_output(fmt: str):
-    return render_template("partials/preview-window.html", fmt=fmt)
+    if fmt not in ("PDF", "LaTeX"):
+        abort(400)
+    if request.args.get("poll") and (key := session.get("preview_key")):
+        # the placeholder checking back on the render it's waiting for; no need to reload the cards
+        return render_template("partials/preview-window.html", fmt=fmt, ready=not render_pending(key))
+    ready = True
+    if cards := session_cards():
+        session["preview_key"] = key = start_render(fmt, cards, session.get("options"))
+        ready = not render_pending(key)
+    return render_template("partials/preview-window.html", fmt=fmt, ready=ready)
 
 
 @app.get("/ajax/preview-src/<fmt>")
 def preview_output_src(fmt: str):
-    if len(session.get("cards", [])) == 0:
+    if not session.get("card_uuids"):
         return "No preview available..."
    
-    cache_file, mime_type = get_cache_file()
-    if cache_file:
-        print(f"Returning cached file '{cache_file}'")
-        return send_file(cache_file, mimetype=mime_type)
-
-    print(f"GENERATING {fmt} file")
-    out_file = None
-    mime_type = None
-    match fmt:
-        case "PDF":
-            out_file = render_pdf(session["cards"], session.get("options"))
-        case "LaTeX":
-            out_file = render_latex(session["cards"], session.get("options"))
-            mime_type = "text/x-tex"
-        case _:
-            abort(400)
-    set_cache_file(out_file, mime_type)
-    return send_file(out_file, mimetype=mime_type)
+    # checked before loading the cards, so polls for a finished preview never unpickle them
+    key = session.get("preview_key")
+    if preview := preview_cache.get(key):
+        log.debug("Returning cached preview '%s'", key)
+        return send_preview(key, preview)
+
+    if fmt not in ("PDF", "LaTeX"):
+        abort(400)
+    if not (cards := session_cards()):
+        return "No preview available..."
+    session["preview_key"] = key = start_render(fmt, cards, session.get("options"))
+    if preview := preview_cache.get(key):
+        log.debug("Returning shared cached preview '%s'", key)
+        return send_preview(key, preview)
+
+    with _render_jobs_lock:
+        error = _render_failures.pop(key, None)  # reported once; the next request retries
+    if error is not None:
+        return f"Error generating {fmt} preview: {error}", 500
+    return "Generating preview...", 202, {"Retry-After": "1"}
 
 @app.route("/ajax/card/<uuid>/verse/<int:num>/edit", methods=["GET", "PUT"])
 def edit_card_verse_text(uuid: str, num: int):
-    c = get_session_card(uuid)
+    stored = stored_cards()
+    c = get_session_card(uuid, stored)
     v = c.get_verse(num)
 
     match request.method:
@@ -196,8 +407,8 @@ def edit_card_verse_text(uuid: str, num: int):
             if not new_text in v.text:
                 abort(403)  # you are not permitted to _change_ the Word
             v.text = new_text
-            session.modified = True
-            bust_cache_file()
+            save_session_card(c, stored)
+            bust_cache_file(session_cards(stored))
             return make_response(render_template("partials/verse_text.html", card=c, verse=v),
                 push_url=False, trigger={"preview-update": True})
         case _:
@@ -212,18 +423,17 @@ def cancel_edit_card_verse_text(uuid: str, num: int):
 
 @app.route("/ajax/card/<uuid>/title/edit", methods=["GET", "PUT"])
 def edit_card_title(uuid: str):
-    c = get_session_card(uuid)
+    stored = stored_cards()
+    c = get_session_card(uuid, stored)
     match request.method:
         case "GET":
             return render_template("partials/card_edit_title.html", card=c)
         case "PUT":
             c.title = request.form["newtitle"]
-            session.modified = True
-            bust_cache_file()
+            save_session_card(c, stored)
+            bust_cache_file(session_cards(stored))
             return make_response(
-                render_template("partials/full_card.html", 
-                    card=c, 
-                    card_option_map=CARD_OPTION_MAP), 
+                render_template("partials/full_card.html", card=c), 
                 push_url=False, 
                 trigger={"preview-update": True})
 
@@ -231,12 +441,11 @@ def edit_card_title(uuid: str):
 @app.get("/ajax/card/<uuid>")
 def cancel_edit_card_title(uuid: str):
     c = get_session_card(uuid)
-    return render_template("partials/full_card.html", 
-        card=c, 
-        card_option_map=CARD_OPTION_MAP)
+    return render_template("partials/full_card.html", card=c)
 
 
 def main(argv: list[str]):
+    logging.basicConfig(level=logging.WARNING)
     app.run(host="localhost", port=1769, debug=True)
 
 
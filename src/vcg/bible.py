@@ -1,10 +1,24 @@
 '''Tools for parsing/expanding machine-readable Bible databases.
 '''
 from __future__ import annotations
+import functools
+import hashlib
 import os
+import pickle
 import re
+import sys
+import tempfile
+from array import array
 from collections import defaultdict, namedtuple
-from typing import Iterable, List, Optional, TextIO, Tuple
+from itertools import chain, repeat
+from typing import Iterable, List, Optional, Tuple
+
+# RE2 (`pip install google-re2`, or the `vcg[re2]` extra) matches in guaranteed linear time;
+# the stdlib engine is a drop-in fallback for the reference pattern below
+try:
+    import re2 as _re
+except ImportError:
+    _re = re
 
 
 # Calculate the path to our default Bible
@@ -13,6 +27,12 @@ _vcg_dir = os.path.dirname(__file__)
 _default_file = os.path.join(_vcg_dir, "data", "kjvdat.txt")
 BIBLE_FILE = os.environ.get("BIBLE_FILE", _default_file)
 
+# Per-user home for the parsed-database pickle when the database's own directory isn't private to us
+USER_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "vcg")
+
+# Bump whenever the pickled layout of BibleBooks changes
+PICKLE_VERSION = 3
+
 
 # Simple types and compiled regexen
 ###################################
@@ -20,8 +40,6 @@ BIBLE_FILE = os.environ.get("BIBLE_FILE", _default_file)
 VerseRef = namedtuple("VerseRef", ("book", "chapter", "verse"))
 Verse = namedtuple("Verse", ("book", "chapter", "verse", "text"))
 
-RX_VLINE = re.compile(r"^([^|]+)\|([^|]+)\|([^|]+)\|\s+([^~]+)~\s*$")
-
 # TODO: move out to JSON formatted file that can be user-specified
 BOOK_NAMES = {
     "Gen": "Genesis",
@@ -161,15 +179,44 @@ SHORT_BOOK_NAMES = {
     "Rev": "Rev",
 }
 
+_BOOK_NAMES_ITEMS = tuple(BOOK_NAMES.items())
+_SHORT_BOOK_NAMES_ITEMS = tuple(SHORT_BOOK_NAMES.items())
+
+
 def parse_verse_line(line: str) -> Verse:
     '''Parse a verse-database line of text into a Verse.
 
-    Raises a SyntaxError if the required pattern doesn't match.
+    Raises a SyntaxError if the line doesn't have the four `|`-delimited fields.
     '''
-    m = RX_VLINE.match(line)
-    if not m:
+    parts = line.split("|", 3)
+    if len(parts) != 4:
         raise SyntaxError(f"invalid verse line '{line}'")
-    return Verse(m.group(1), int(m.group(2)), int(m.group(3)), m.group(4))
+    text = parts[3].strip()
+    if text.endswith("~"):
+        text = text[:-1].rstrip()
+    return Verse(sys.intern(parts[0]), int(parts[1]), int(parts[2]), text)
+
+
+def _is_private(st: os.stat_result) -> bool:
+    '''True if a stat()ed file/directory is ours and no one else can write to it.'''
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def _pickle_cache_file(filename: str) -> Optional[str]:
+    '''Where to cache the parsed `filename` (None if nowhere safe).'''
+    data_dir, base = os.path.split(os.path.abspath(filename))
+    stem = os.path.splitext(base)[0]
+    try:
+        if _is_private(os.stat(data_dir)):
+            return os.path.join(data_dir, stem + ".pkl")
+        os.makedirs(USER_CACHE_DIR, mode=0o700, exist_ok=True)
+        if _is_private(os.stat(USER_CACHE_DIR)):
+            # keyed by the database's directory, so same-named databases don't collide
+            tag = hashlib.blake2b(data_dir.encode("utf-8"), digest_size=8).hexdigest()
+            return os.path.join(USER_CACHE_DIR, f"{stem}-{tag}.pkl")
+    except OSError:
+        pass
+    return None
 
 
 # TODO: replace "BibleBooks" class with two classes: BibleMap and BibleText
@@ -192,51 +239,116 @@ class BibleBooks:
     
     Uses the `kjvdat.txt` file format described in `README.md`.
     '''
-    def __init__(self, stream: TextIO):
-        self._verses = {}
+    def __init__(self, data: bytes):
+        self._text = []         # verse texts, in file (canonical) order
+        self._offsets = {}      # packed (book_i << 12) | chapter -> index of verse 1 in `_text`
         self._books = {}
-
-        cur_book = None
-        max_verses = {}
-        cur_chapter = None
-        last_verse = None
-        for line in stream:
-            book, chapter, verse, text = parse_verse_line(line)
-            self._verses[VerseRef(book, chapter, verse)] = text
-            
-            if chapter != cur_chapter:
-                if cur_chapter:
-                    max_verses[cur_chapter] = last_verse
-                cur_chapter = chapter
-           
-            if book != cur_book:
-                if cur_book:
-                    self._books[cur_book] = max_verses 
-                    max_verses = {}
-                cur_book = book
-            last_verse = verse
-        max_verses[chapter] = last_verse
-        self._books[book] = max_verses
+        self._book_idx = {}
+
+        # same field handling as `parse_verse_line`, inlined to skip a call and a Verse per line
+        for line in data.decode("utf8").splitlines():
+            parts = line.split("|", 3)
+            if len(parts) != 4:
+                if line.strip():
+                    raise SyntaxError(f"invalid verse line '{line}'")
+                continue
+            book, chapter, verse, text = sys.intern(parts[0]), int(parts[1]), int(parts[2]), parts[3].strip()
+            if text.endswith("~"):
+                text = text[:-1].rstrip()
+
+            book_i = self._book_idx.setdefault(book, len(self._book_idx))
+            offset = self._offsets.setdefault((book_i << 12) | chapter, len(self._text))
+            if offset + verse - 1 != len(self._text):
+                raise SyntaxError(f"out-of-sequence verse '{book}|{chapter}|{verse}'")
+            self._text.append(text)
+            self._books.setdefault(book, {})[chapter] = verse
+        self._book_seq = tuple(self._book_idx)
+        # chapter -> last verse, as a dense array indexed by chapter - 1 (0 for a missing chapter)
+        for book, limits in self._books.items():
+            self._books[book] = array("H", (limits.get(c, 0) for c in range(1, max(limits) + 1)))
+        # the same limits for every book in one flat table, indexed by (book_i << _chap_bits) | chapter
+        self._chap_bits = max(map(len, self._books.values()), default=0).bit_length()
+        self._last_verses = array("H", bytes(2 * (len(self._book_seq) << self._chap_bits)))
+        for book_i, book in enumerate(self._book_seq):
+            base = book_i << self._chap_bits
+            self._last_verses[base + 1 : base + len(self._books[book]) + 1] = self._books[book]
 
     @staticmethod
+    @functools.cache
     def fromfile(filename: str = BIBLE_FILE) -> BibleBooks:
-        with open(filename, "rt", encoding="utf8") as fd:
-            return BibleBooks(fd)
+        '''Load a verse database (once per process), via a pickle cache when fresh.
+
+        The pickle (`<name>.pkl`) lives next to the database if that directory is ours and no one else
+        can write to it, and in `USER_CACHE_DIR` otherwise; it is only loaded if it passes the same check.
+        It is rebuilt whenever it is older than the database; failure to write it is not an error.
+        '''
+        cache_file = _pickle_cache_file(filename)
+        if cache_file is not None:
+            try:
+                with open(cache_file, "rb") as fd:
+                    st = os.fstat(fd.fileno())
+                    if _is_private(st) and st.st_mtime >= os.path.getmtime(filename):
+                        version, bb = pickle.load(fd)
+                        if version == PICKLE_VERSION:
+                            return bb
+            except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+                pass
+
+        with open(filename, "rb") as fd:
+            bb = BibleBooks(fd.read())
+        if cache_file is None:
+            return bb
+
+        scratch_file = None
+        try:
+            scratch_fd, scratch_file = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(cache_file))
+            with os.fdopen(scratch_fd, "wb") as fd:
+                pickle.dump((PICKLE_VERSION, bb), fd, protocol=pickle.HIGHEST_PROTOCOL)
+            os.chmod(scratch_file, 0o644)
+            os.replace(scratch_file, cache_file)  # atomic, so concurrent loaders never see a partial pickle
+        except OSError:
+            if scratch_file and os.path.exists(scratch_file):
+                os.unlink(scratch_file)
+        return bb
     
+    def __setstate__(self, state: dict):
+        # unpickling doesn't intern strings, so re-key the book tables by the interned names
+        self.__dict__.update(state)
+        self._books = {sys.intern(book): limits for book, limits in self._books.items()}
+        self._book_idx = {sys.intern(book): i for book, i in self._book_idx.items()}
+        self._book_seq = tuple(self._book_idx)
+
     def last_chapter(self, book: str) -> int:
-        return max(self._books[book])
+        return len(self._books[book])
+
+    def chapter_lengths(self, book: str) -> array:
+        '''Last verse of each chapter of `book`, indexed by chapter - 1.'''
+        return self._books[book]
 
     def last_verse(self, book: str, chapter: int) -> int:
-        return self._books[book][chapter]
+        limits = self._books[book]
+        if not (0 < chapter <= len(limits) and limits[chapter - 1]):
+            raise KeyError((book, chapter))
+        return limits[chapter - 1]
+
+    def book_id(self, book: str) -> int:
+        '''Position of `book` in the database, for `last_verse_id`.'''
+        return self._book_idx[book]
+
+    def last_verse_id(self, book_id: int, chapter: int) -> int:
+        '''`last_verse` by `book_id`, read from one flat table instead of per-book arrays.'''
+        if not (0 < chapter < (1 << self._chap_bits) and 0 <= book_id < len(self._book_seq)):
+            raise KeyError((book_id, chapter))
+        last = self._last_verses[(book_id << self._chap_bits) | chapter]
+        if not last:
+            raise KeyError((book_id, chapter))
+        return last
 
     def is_valid_ref(self, v: VerseRef) -> bool:
-        if v.book not in self._books:
-            return False
-        if v.chapter not in self._books[v.book]:
+        limits = self._books.get(v.book)
+        if limits is None or not 0 < v.chapter <= len(limits):
             return False
-        if v.verse < 1 or v.verse > self._books[v.book][v.chapter]:
-            return False
-        return True
+        return 0 < v.verse <= limits[v.chapter - 1]
 
     def get_next_ref(self, v: VerseRef) -> VerseRef:
         if not self.is_valid_ref(v):
@@ -247,11 +359,11 @@ class BibleBooks:
         inc_chapter = VerseRef(v.book, v.chapter + 1, 1)
         if self.is_valid_ref(inc_chapter):
             return inc_chapter
-        book_seq = list(self._books)
-        book_i = book_seq.index(v.book)
-        inc_book = VerseRef(book_seq[book_i + 1], 1, 1)
-        if self.is_valid_ref(inc_book):
-            return inc_book
+        book_i = self._book_idx[v.book] + 1
+        if book_i < len(self._book_seq):
+            inc_book = VerseRef(self._book_seq[book_i], 1, 1)
+            if self.is_valid_ref(inc_book):
+                return inc_book
         raise StopIteration()
 
     def refs_are_contiguous(self, v1: VerseRef, v2: VerseRef) -> bool:
@@ -260,110 +372,199 @@ class BibleBooks:
     def pretty_name(self, abbrev: str, short: bool = False) -> str:
         return BOOK_NAMES[abbrev] if not short else SHORT_BOOK_NAMES[abbrev]
 
-    def pretty_names(self, short: bool = False) -> Iterable[Tuple[str, str]]:
-        return list(BOOK_NAMES.items()) if not short else list(SHORT_BOOK_NAMES.items())
+    def pretty_names(self, short: bool = False) -> Tuple[Tuple[str, str], ...]:
+        return _BOOK_NAMES_ITEMS if not short else _SHORT_BOOK_NAMES_ITEMS
+
+    def index(self, ref: VerseRef) -> int:
+        '''Position of a verse in canonical order (raises KeyError if it doesn't exist).'''
+        book, chapter, verse = ref
+        limits = self._books[book]
+        if not (0 < chapter <= len(limits) and 0 < verse <= limits[chapter - 1]):
+            raise KeyError(ref)
+        return self._offsets[(self._book_idx[book] << 12) | chapter] + verse - 1
+
+    def iter_refs(self, start: VerseRef, end: VerseRef) -> Iterable[VerseRef]:
+        '''Every reference from `start` through `end` (inclusive, same book).'''
+        book, chap, verse = start
+        _, end_chap, end_verse = end
+        limits = self.chapter_lengths(book)
+        if not 0 < chap <= end_chap <= len(limits):
+            raise KeyError(end)
+        if start == end:
+            return (start,)
+        # whole chapter at a time, with the per-verse loop run by map/zip rather than a Python frame
+        make = VerseRef._make
+        if chap == end_chap:
+            return map(make, zip(repeat(book), repeat(chap), range(verse, end_verse + 1)))
+        return chain.from_iterable(
+            map(make, zip(repeat(book), repeat(cnum), range(verse if cnum == chap else 1,
+                (limits[cnum - 1] if cnum < end_chap else end_verse) + 1)))
+            for cnum in range(chap, end_chap + 1))
+
+    def iter_range(self, start: VerseRef, end: VerseRef) -> List[str]:
+        '''Texts of every verse from `start` through `end` (inclusive), as one slice.'''
+        return self._text[self.index(start) : self.index(end) + 1]
+
+    def numbered_range(self, start: VerseRef, end: VerseRef) -> Iterable[Tuple[int, str]]:
+        '''(verse number, text) of every verse from `start` through `end` (inclusive, same book).
+
+        Texts come from one slice; numbers from a `range` per chapter (no VerseRefs are built).
+        '''
+        book, chap, verse = start
+        _, end_chap, end_verse = end
+        texts = self._text[self.index(start) : self.index(end) + 1]
+        if chap == end_chap:
+            return zip(range(verse, end_verse + 1), texts)
+        limits = self._books[book]
+        nums = chain(range(verse, limits[chap - 1] + 1),
+            *(range(1, limits[cnum - 1] + 1) for cnum in range(chap + 1, end_chap)),
+            range(1, end_verse + 1))
+        return zip(nums, texts)
 
     def __getitem__(self, ref: VerseRef) -> str:
-        return self._verses[ref]
-
+        return self._text[self.index(ref)]
 
-RX_WS = re.compile(r"\s*")
-RX_NAME = re.compile(r"([A-Za-z][A-Za-z0-9]*)\s+")
-RX_NUM = re.compile(r"([0-9]+)\s*")
 
+# Book-anchored reference pattern: one `;`-delimited "[Book] C[:spec]" group per match
+RX_REF = _re.compile(
+    r"\s*(?:(?P<book>" + "|".join(map(re.escape, BOOK_NAMES)) + r")\s+)?"
+    r"(?P<chap>\d+)\s*(?::\s*(?P<spec>[\d,\-:]+(?:\s+[\d,\-:]+)*)\s*)?(?:;|$)")
+# One item of a verse spec ("V", "V-V2", or "V-C2:V2"), with its leading `,` after the first
+RX_SPAN = re.compile(r"(?:\A|,)\s*(\d+)\s*(?:-\s*(?:(\d+)\s*:\s*)?(\d+)\s*)?")
+# Single tokens, for pinpointing syntax errors
+RX_WORD = re.compile(r"[^\W\d_]\w*")
+RX_NUM = re.compile(r"\d+")
 
-class ParseStream:
-    '''Recursive-descent parser for a sequence of book/chapter/verse references, usually for giving a range of verses to select.'''
-    def __init__(self, s: str):
-        self._s = s
-        self._pos = 0
-        self.eat_ws()
 
-    def eos(self) -> bool:
-        return self._pos >= len(self._s) 
+def _syntax_error(ref: str, pos: int, book: Optional[str]) -> SyntaxError:
+    '''Explain why the entry of `ref` starting at `pos` doesn't parse, naming the first offending token.
 
-    def peek(self, span=1) -> str:
-        return self._s[self._pos : self._pos + span]
+    Only used once a parse has already failed, so it re-walks the entry a token at a time.
+    '''
+    def skip_ws(i: int) -> int:
+        while i < len(ref) and ref[i].isspace():
+            i += 1
+        return i
+
+    def found(i: int) -> str:
+        if i >= len(ref):
+            return "end of reference"
+        token = RX_WORD.match(ref, i) or RX_NUM.match(ref, i)
+        return f"'{token[0] if token else ref[i]}'"
+
+    i = skip_ws(pos)
+    if word := RX_WORD.match(ref, i):
+        if word[0] not in BOOK_NAMES:
+            return SyntaxError(f"unknown book '{word[0]}'")
+        i = skip_ws(word.end())
+    elif book is None:
+        return SyntaxError("expected name")
+    if not (num := RX_NUM.match(ref, i)):
+        return SyntaxError(f"expected chapter number, found {found(i)}")
+    i = skip_ws(num.end())
+
+    # verse items are "V", "V-V2", or "V-C2:V2"; `after` is the separator just read,
+    # and `allowed` the separators that may follow the next number
+    if i < len(ref) and ref[i] == ":":
+        after, allowed = ":", ",-"
+        while after:
+            i = skip_ws(i + 1)
+            if not (num := RX_NUM.match(ref, i)):
+                return SyntaxError(f"expected verse number after '{after}', found {found(i)}")
+            i = skip_ws(num.end())
+            after = ref[i] if i < len(ref) and ref[i] in allowed else None
+            allowed = {",": ",-", "-": ",:", ":": ","}.get(after)
+    if i < len(ref) and ref[i] != ";":
+        return SyntaxError(f"unexpected {found(i)}")
+    return SyntaxError(f"invalid reference '{ref[pos:].split(';')[0].strip()}'")
+
+
+def parse_spans(ref: str, bb: Optional[BibleBooks] = None) -> Iterable[Tuple[VerseRef, VerseRef]]:
+    '''Parse a sequence of one or more ';'-delimited book/chapeter/verse[set-or-range] entries, yielding inclusive (start, end) spans.
+
+    Only the first entry must name a book; later entries without one continue in the same book.
+    '''
+    if bb is None:
+        bb = BibleBooks.fromfile()
 
-    def eat(self, pat, return_group=0) -> Optional[str]:
-        m = pat.match(self._s, pos=self._pos)
-        if m:
-            self._pos += len(m.group(0))
-            return m.group(return_group)
-        else:
-            return None
+    # hoisted out of the loops below (plain local loads instead of global/attribute lookups)
+    vref, last_verse_id, span_iter = VerseRef, bb.last_verse_id, RX_SPAN.finditer
 
-    def eat_ws(self):
-        self.eat(RX_WS)
+    book = None
+    pos = 0
+    for m in RX_REF.finditer(ref):
+        if m.start() != pos:
+            break
+        entry, pos = pos, m.end()
 
-    def read_name(self) -> str:
-        name = self.eat(RX_NAME, return_group=1)
-        if name is None:
+        if m["book"]:
+            book = sys.intern(m["book"])  # shared by every VerseRef below, and identical to the database's keys
+            book_id = bb.book_id(book)
+        if book is None:
             raise SyntaxError("expected name")
-        return name
-    
-    def read_num(self) -> int:
-        num = self.eat(RX_NUM, return_group=1)
-        if num is None:
-            raise SyntaxError("expected number")
-        return int(num)
-
-    def require(self, literal: str):
-        if self.peek(len(literal)) != literal:
-            raise SyntaxError(f"expected '{literal}'")
-        self._pos += len(literal)
-        self.eat_ws()
-
-    def accept(self, literal: str) -> bool:
-        if self.peek(len(literal)) == literal:
-            self._pos += len(literal)
-            self.eat_ws()
-            return True
-        else:
-            return False
+        chap = int(m["chap"])
+        spec = m["spec"]
+        if spec is None:
+            try:
+                last = last_verse_id(book_id, chap)
+            except KeyError:
+                raise KeyError((book, chap)) from None
+            yield vref(book, chap, 1), vref(book, chap, last)
+            continue
+
+        # hand-scanned fast paths for the commonest specs, "V" and "V-V2"
+        if spec.isdigit():
+            start = vref(book, chap, int(spec))
+            yield start, start
+            continue
+        first, _, last = spec.partition("-")
+        if first.isdigit() and last.isdigit():
+            start, end = vref(book, chap, int(first)), vref(book, chap, int(last))
+            if end < start:
+                raise SyntaxError(f"backwards verse span '{spec}'")
+            yield start, end
+            continue
+        # ...and for plain verse lists ("V,V,V"), where one C-level split finds every separator
+        if "-" not in spec and ":" not in spec:
+            verses = [v.strip() for v in spec.split(",")]
+            if all(map(str.isdigit, verses)):
+                for v in verses:
+                    start = vref(book, chap, int(v))
+                    yield start, start
+                continue
+
+        spec_pos = 0
+        for span in span_iter(spec):
+            if span.start() != spec_pos:
+                break
+            spec_pos = span.end()
+
+            start = vref(book, chap, int(span[1]))
+            if span[3] is None:
+                yield start, start
+                continue
 
+            if span[2] is not None:
+                chap = int(span[2])
+            end = vref(book, chap, int(span[3]))
+            if end < start:
+                raise SyntaxError(f"backwards verse span '{span[0].removeprefix(',').strip()}'")
+            yield start, end
 
-def parse_ref(ref: str, bb: Optional[BibleBooks] = None) -> Iterable[VerseRef]:
-    '''Parse a sequence of one or more ';'-delimited book/chapeter/verse[set-or-range] entries, yielding the stream of verses selected.'''
+        if spec_pos != len(spec):
+            raise _syntax_error(ref, entry, book)
+
+    if ref[pos:].strip():
+        raise _syntax_error(ref, pos, book)
+
+
+def parse_ref(ref: str, bb: Optional[BibleBooks] = None) -> List[VerseRef]:
+    '''Parse a sequence of one or more ';'-delimited book/chapeter/verse[set-or-range] entries, returning the list of verses selected.'''
     if bb is None:
         bb = BibleBooks.fromfile()
 
-    ps = ParseStream(ref)
-    book = None
-    while not ps.eos():
-        if not book:
-            book = ps.read_name()
-        chap = ps.read_num()
-        if ps.eos():
-            for i in range(1, bb.last_verse(book, chap) + 1):
-                yield VerseRef(book, chap, i)
-            break
-        ps.require(":")
-        verse = ps.read_num()
-        
-        yield VerseRef(book, chap, verse)
-
-        while not ps.eos():
-            if ps.accept(","):
-                verse = ps.read_num()
-                yield VerseRef(book, chap, verse)
-            elif ps.accept("-"):
-                end_span = ps.read_num()
-                if ps.accept(":"):
-                    for cnum in range(chap, end_span):
-                        last_verse = bb.last_verse(book, cnum)
-                        for vnum in range(verse + 1, last_verse + 1):
-                            yield VerseRef(book, cnum, vnum)
-                        verse = 0
-                    end_verse = ps.read_num()
-                    chap = end_span
-                else:
-                    end_verse = end_span
-
-                for vnum in range(verse+1, end_verse+1):
-                    yield VerseRef(book, chap, vnum)
-            elif ps.accept(";"):
-                break
-            else:
-                raise SyntaxError(f"unexpected '{ps.peek()}'")
-
+    refs = []
+    extend, iter_refs = refs.extend, bb.iter_refs
+    for start, end in parse_spans(ref, bb):
+        extend(iter_refs(start, end))
+    return refs
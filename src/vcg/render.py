@@ -3,19 +3,28 @@
 Works via shelling out to `pdflatex`, uses the `flashcards` document class, 
 and relies on the `tabularx` package peing available.
 """
+import functools
+import hashlib
 import os
 import subprocess
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 
-import pystache
-
 from .model import Card, Verse
 
 
 LATEX_FONT_SIZES = [f"\\{sz}" for sz in "tiny scriptsize footnotesize small normalsize large Large LARGE huge Huge".split()]
 FLASHCARD_PAPER_SIZES = ["avery5371", "avery5388"]
 
+# Debugging aid: render via the reference mustache template instead of the direct string builder
+USE_PYSTACHE = bool(os.environ.get("VCG_USE_PYSTACHE"))
+
+# Where dumped preamble formats (see `preamble_format`) are kept between runs; per-user,
+# since pdflatex will load whatever format it finds there
+FORMAT_DIR = os.environ.get("VCG_FORMAT_DIR") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "vcg", "fmt")
+
 
 @dataclass
 class Option:
@@ -26,7 +35,7 @@ class Option:
     default: object | None = None
 
     def validate(self, value) -> object:
-        if not isinstance(value, self.kind):
+        if type(value) is not self.kind:
             value = self.kind(value)
         if self.choices is not None and value not in self.choices:
             raise ValueError(f"'{value}' is not in the list of allowed values")
@@ -65,10 +74,9 @@ CARD_OPTION_MAP = {
 }
 
 
-def global_options(options: dict[str, object] | None = None) -> str:
-    """Validate/default and render a set of global options to document class attributes."""
-    if options is None:
-        options = {}
+@functools.lru_cache(maxsize=256)
+def _flat_global_options(option_items: frozenset) -> str:
+    options = dict(option_items)
     flats = []
     for okey, odef in DOC_OPTION_MAP.items():
         goval = odef.validate(options.get(okey, odef.default))
@@ -76,10 +84,29 @@ def global_options(options: dict[str, object] | None = None) -> str:
     return ','.join(filter(None, flats))
 
 
+# The (common) all-defaults case, flattened once up front
+_DEFAULT_DOC_OPTIONS = _flat_global_options(frozenset())
+
+
+def global_options(options: dict[str, object] | None = None) -> str:
+    """Validate/default and render a set of global options to document class attributes."""
+    if not options:
+        return _DEFAULT_DOC_OPTIONS
+    return _flat_global_options(frozenset(options.items()))
+
+
+@functools.lru_cache(maxsize=256)
+def _validated_card_options(option_items: frozenset) -> dict[str, object]:
+    options = dict(option_items)
+    return {okey: odef.validate(options.get(okey, odef.default)) for okey, odef in CARD_OPTION_MAP.items()}
+
+
 def optimized_card(card: Card) -> Card:
-    """Make sure the card's options are fully validated/defaulted."""
-    for okey, odef in CARD_OPTION_MAP.items():
-        card.options[okey] = odef.validate(card.options.get(okey, odef.default))
+    """Make sure the card's options are fully validated/defaulted.
+
+    Cards sharing an option preset share one (cached) validation.
+    """
+    card.options.update(_validated_card_options(frozenset(card.options.items())))
     return card
 
 
@@ -99,6 +126,71 @@ r"""{{=<< >>=}}\documentclass[<<doc_options>>]{flashcards}
 \end{document}
 """
 
+@functools.cache
+def _mustache() -> tuple:
+    """The (renderer, parsed template) pair for `CARD_SHEET_TEMPLATE`, built on first use.
+
+    Only the `USE_PYSTACHE` path needs pystache, so normal renders never import it.
+    """
+    import pystache
+    return pystache.Renderer(escape=lambda s: s), pystache.parse(CARD_SHEET_TEMPLATE)
+
+
+def latex_card(card: Card) -> str:
+    """Render one (validated/defaulted) card as LaTeX, exactly as `CARD_SHEET_TEMPLATE` would."""
+    opts = optimized_card(card).options
+    head = f"\\begin{{flashcard}}{{{opts['title_size']}{{{card.title}}}}}"
+    if opts["columns"]:
+        head += "\n\\begin{multicols}{2}"
+    if opts["ragged_right"]:
+        head += "\n\\raggedright"
+    par = "\\par" if opts["paragraphs"] else ""
+    num_size, text_size = opts["num_size"], opts["text_size"]
+    body = "".join(f"{par}\\textsuperscript{{\\textit{{{num_size}{{{v.num}}}}}}}{text_size}{{{v.text}}}\n" 
+        for v in card.verses)
+    tail = "\\end{multicols}\n" if opts["columns"] else ""
+    return f"{head}\n{body}{tail}\\end{{flashcard}}\n"
+
+
+def latex_source(cards: list[Card], options: dict[str, object] | None = None) -> str:
+    """Render a batch of cards as LaTeX source text.
+
+    `options` is a dictionary of global/document options (allowed to be empty/defaulted).
+    """
+    if USE_PYSTACHE:
+        for c in cards:
+            optimized_card(c)  # in place, so the template can walk `cards` itself
+        context = {
+            "doc_options": global_options(options),
+            "cards": cards,
+        }
+        renderer, template = _mustache()
+        return renderer.render(template, context)
+
+    return latex_preamble(options) + latex_body(cards)
+
+
+def latex_preamble(options: dict[str, object] | None = None) -> str:
+    """Render the document preamble (everything before `\\begin{document}`) for the given options."""
+    return (f"\\documentclass[{global_options(options)}]{{flashcards}}\n"
+        "\\usepackage{multicol}\n")
+
+
+def latex_body(cards: list[Card]) -> str:
+    """Render the document body (`\\begin{document}` through `\\end{document}`) for a batch of cards."""
+    return ("\\begin{document}\n"
+        + "".join(latex_card(c) for c in cards)
+        + "\\end{document}\n")
+
+
+def _write_latex_body(fd, cards: list[Card]) -> None:
+    """Write what `latex_body` returns to `fd`, a card at a time."""
+    write = fd.write
+    write("\\begin{document}\n")
+    for c in cards:
+        write(latex_card(c))
+    write("\\end{document}\n")
+
 
 def render_latex(cards: list[Card], options: dict[str, object] | None = None, filename: str | None = None) -> str:
     """Render a batch of cards as LaTeX and return the filename used.
@@ -112,33 +204,163 @@ def render_latex(cards: list[Card], options: dict[str, object] | None = None, fi
         scratch_fd, filename = tempfile.mkstemp(suffix=".tex")
         os.close(scratch_fd)
 
-    rnd = pystache.Renderer(escape=lambda s: s)
-    template = pystache.parse(CARD_SHEET_TEMPLATE)
-    context = {
-        "doc_options": global_options(options),
-        "cards": [optimized_card(c) for c in cards],
-    }
-    with open(filename, "wt", encoding="utf-8") as fd:
-        print(rnd.render(template, context), file=fd)
+    # streamed a card at a time (through a large buffer) rather than built as one string first
+    with open(filename, "wt", encoding="utf-8", buffering=1 << 20) as fd:
+        if USE_PYSTACHE:
+            fd.write(latex_source(cards, options))
+        else:
+            fd.write(latex_preamble(options))
+            _write_latex_body(fd, cards)
 
     return filename
 
 
-def render_pdf(cards: list[Card], options: dict[str, object] = {}, keep_temp_dir: bool = False) -> str:
+_PDFLATEX = ['pdflatex', '-interaction=batchmode', '-halt-on-error']
+
+# Preambles whose format dump failed; these always compile from full source
+_failed_formats: set[str] = set()
+
+
+def _private_format_dir() -> bool:
+    """Create `FORMAT_DIR` if needed; True only if it is ours and no one else can write to it."""
+    try:
+        os.makedirs(FORMAT_DIR, mode=0o700, exist_ok=True)
+        st = os.stat(FORMAT_DIR)
+    except OSError:
+        return False
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def preamble_format(preamble: str) -> str | None:
+    """Return the name of a `pdflatex` format file with `preamble` preloaded, building it on first use.
+
+    Formats live in `FORMAT_DIR` (one per distinct preamble, i.e. per set of document options).
+    Returns None if the format can't be built (or `FORMAT_DIR` isn't private to this user),
+    in which case callers should compile the full source.
+    """
+    if not _private_format_dir():
+        return None
+    name = "vcg-" + hashlib.blake2b(preamble.encode("utf-8"), digest_size=8).hexdigest()
+    if name in _failed_formats:
+        return None
+    if os.path.exists(os.path.join(FORMAT_DIR, name + ".fmt")):
+        return name
+
+    try:
+        with tempfile.TemporaryDirectory(dir=FORMAT_DIR) as build_dir:
+            with open(os.path.join(build_dir, "preamble.tex"), "wt", encoding="utf-8") as fd:
+                fd.write(preamble)
+            subprocess.run(_PDFLATEX + ['-ini', f'-jobname={name}', '&pdflatex preamble.tex\\dump'],
+                cwd=build_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            os.replace(os.path.join(build_dir, name + ".fmt"), os.path.join(FORMAT_DIR, name + ".fmt"))
+    except (OSError, subprocess.CalledProcessError):
+        _failed_formats.add(name)
+        return None
+    return name
+
+
+def compile_pdf(cards: list[Card], options: dict[str, object] | None, temp_dir: str) -> str:
+    """Render a batch of verse cards to LaTeX in `temp_dir`, run `pdflatex` there, and return the PDF's path.
+
+    Loads the preamble from a cached format file when one is available (so only the body is compiled),
+    falling back to compiling the full source if that fails. The format is only discarded when the
+    fallback succeeds (i.e., the format rather than the document was at fault).
+    """
+    source_file = os.path.join(temp_dir, "source.tex")
+    fmt = None if USE_PYSTACHE else preamble_format(latex_preamble(options))
+    if fmt is not None:
+        with open(source_file, "wt", encoding="utf-8", buffering=1 << 20) as fd:
+            _write_latex_body(fd, cards)
+        try:
+            subprocess.run(_PDFLATEX + [f'-fmt={fmt}', 'source.tex'],
+                cwd=temp_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                env=dict(os.environ, TEXFORMATS=FORMAT_DIR + os.pathsep))
+            return os.path.join(temp_dir, "source.pdf")
+        except subprocess.CalledProcessError:
+            pass
+
+    render_latex(cards, options=options, filename=source_file)
+    subprocess.run(_PDFLATEX + ['source.tex'],
+        cwd=temp_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    if fmt is not None:
+        # Stale (e.g. built by an older TeX) or otherwise unusable; stop using it for this process
+        _failed_formats.add(fmt)
+        try:
+            os.unlink(os.path.join(FORMAT_DIR, fmt + ".fmt"))
+        except OSError:
+            pass
+    return os.path.join(temp_dir, "source.pdf")
+
+
+def pdf_bytes(cards: list[Card], options: dict[str, object] | None = None) -> bytes:
+    """Render a batch of verse cards into a PDF and return its contents.
+
+    Reads the PDF straight out of the temporary build directory, so no output file outlives the call.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with open(compile_pdf(cards, options, temp_dir), "rb") as fd:
+            return fd.read()
+
+
+class PdfRenderSession:
+    """Context manager for rendering many batches of verse cards into PDF files.
+
+    All batches are compiled in one temporary directory (created on enter, removed on exit
+    _unless_ `keep_temp_dir` is True); each batch overwrites the previous one's LaTeX/aux/log files.
+
+        with PdfRenderSession() as session:
+            for batch in batches:
+                pdf_file = session.render(batch, options)
+    """
+
+    def __init__(self, keep_temp_dir: bool = False):
+        self.keep_temp_dir = keep_temp_dir
+        self._temp_dir = None
+
+    def __enter__(self) -> "PdfRenderSession":
+        self._temp_dir = tempfile.TemporaryDirectory(delete=(not self.keep_temp_dir))
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._temp_dir.__exit__(*exc_info)
+        self._temp_dir = None
+
+    def render(self, cards: list[Card], options: dict[str, object] | None = None) -> str:
+        """Render a batch of verse cards into a PDF file and return its path.
+
+        Moves the resulting PDF into a temp file outside the session's directory.
+        """
+        pdf_file = compile_pdf(cards, options, self._temp_dir.name)
+
+        scratch_fd, out_file = tempfile.mkstemp(suffix=".pdf")
+        os.close(scratch_fd)
+        os.rename(pdf_file, out_file)
+        return out_file
+
+
+def render_pdf(cards: list[Card], options: dict[str, object] | None = None, keep_temp_dir: bool = False) -> str:
     """Render a batch of verse cards into a PDF file and return its path.
     
     Generates a temporary directory in which to generate/render LaTeX files.
     Moves the resulting PDF into a temp file outside that temp directory.
     Removes the temp directory _unless_ `keep_temp_dir` is True.
+    Use a `PdfRenderSession` directly to render several batches through one directory.
     """
-    
-    with tempfile.TemporaryDirectory(delete=(not keep_temp_dir)) as temp_dir:
-        render_latex(cards, options=options, filename=os.path.join(temp_dir, "source.tex"))
-        subprocess.run(['pdflatex', 'source.tex'], cwd=temp_dir, check=True)
-        
-        scratch_fd, out_file = tempfile.mkstemp(suffix=".pdf")
-        os.close(scratch_fd)
-        os.rename(os.path.join(temp_dir, "source.pdf"), out_file)
+    with PdfRenderSession(keep_temp_dir=keep_temp_dir) as session:
+        return session.render(cards, options)
+
 
-    return out_file
+def render_pdfs(batches: list[list[Card]], options: dict[str, object] | None = None, max_workers: int | None = None,
+        mp_context=None) -> list[str]:
+    """Render several batches of verse cards into PDF files in parallel and return their paths (in batch order).
 
+    For bulk/offline generation (e.g., a whole-book export); the web app renders one preview at a time.
+    Fans the batches out to a process pool (`max_workers` defaults to one per core);
+    each worker renders through `render_pdf`, and so gets its own temp directory.
+
+    On Linux the pool forks by default, which is unsafe from a multi-threaded process (like the Flask app
+    and its render threads); such callers should pass `mp_context=multiprocessing.get_context("spawn")`.
+    """
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as pool:
+        return list(pool.map(functools.partial(render_pdf, options=options), batches))